@@ -1,10 +1,22 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 import json # Import json
 
 # --- Configuration ---
 BACKEND_URL = "http://localhost:8000"
 
+# Shared session so clone/upgrade/open_vscode calls reuse keep-alive connections to the backend.
+# Cached across Streamlit reruns, which re-execute this script on every interaction.
+@st.cache_resource
+def get_session():
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+    session.headers.update({"Connection": "keep-alive"})
+    return session
+
+SESSION = get_session()
+
 st.title("Java Upgrade Assistant")
 
 git_url = st.text_input("Enter GitLab Project URL:")
@@ -24,7 +36,7 @@ if st.button("Clone and Analyze"):
     else:
         with st.spinner("Cloning and analyzing..."):
             try:
-                resp = requests.post(f"{BACKEND_URL}/clone_and_detect", json={"git_url": git_url})
+                resp = SESSION.post(f"{BACKEND_URL}/clone_and_detect", json={"git_url": git_url})
                 resp.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
                 data = resp.json()
 
@@ -69,36 +81,61 @@ if st.session_state['repo_path'] and st.session_state['current_java_version'] !=
             if not target_version:
                 st.warning("Please select a target Java version.")
             else:
-                with st.spinner(f"Upgrading code to Java {target_version} using Ollama model '{ollama_model}'..."):
+                with st.status(f"Upgrading code to Java {target_version} using Ollama model '{ollama_model}'...", expanded=True) as upgrade_status:
                     try:
                         upgrade_data = {
                             "repo_path": st.session_state['repo_path'],
                             "target_version": target_version,
+                            "current_version": st.session_state['current_java_version'], # Avoid re-detection on the backend
                             "ollama_model": ollama_model # Pass the selected model
                         }
-                        resp = requests.post(f"{BACKEND_URL}/upgrade_java", json=upgrade_data)
+                        resp = SESSION.post(f"{BACKEND_URL}/upgrade_java", json=upgrade_data, stream=True)
                         resp.raise_for_status() # Raise HTTPError for bad responses
 
-                        upgrade_result = resp.json()
+                        if resp.headers.get("content-type", "").startswith("application/x-ndjson"):
+                            # Streamed upgrade: one JSON event per line, file-by-file progress then a final "done" event
+                            upgrade_result = {}
+                            for line in resp.iter_lines():
+                                if not line:
+                                    continue
+                                event = json.loads(line)
+                                if event.get("event") == "file":
+                                    upgrade_status.write(f"Updated `{event['path']}`")
+                                elif event.get("event") == "done":
+                                    upgrade_result = {k: v for k, v in event.items() if k != "event"}
+                        else:
+                            upgrade_result = resp.json()
+
+                        if upgrade_result.get("details"):
+                            # Backend only sends "details" when something went wrong
+                            upgrade_status.update(label=upgrade_result.get("status", "Upgrade finished with errors"), state="error")
+                        else:
+                            upgrade_status.update(label="Upgrade finished", state="complete")
 
                         if "status" in upgrade_result:
-                            if "errors" in upgrade_result.get("details", ""): # Check for errors in details string
-                                st.warning(f"Upgrade Status: {upgrade_result['status']}")
-                                for detail in upgrade_result.get("details", "").splitlines():
-                                     st.write(detail) # Display error details
-                            elif "errors" in upgrade_result: # Check for errors list directly
+                            if upgrade_result.get("details"):
                                 st.warning(f"Upgrade Status: {upgrade_result['status']}")
-                                for err in upgrade_result['details']:
+                                for err in upgrade_result["details"]:
                                     st.error(err)
                             else:
                                 st.success(f"Upgrade Status: {upgrade_result['status']}")
                         else:
                             st.json(upgrade_result) # Display raw result if format unexpected
 
+                        if upgrade_result.get("skipped_files"):
+                            st.warning(f"Skipped {len(upgrade_result['skipped_files'])} files that could not be upgraded automatically (too large or not valid UTF-8):")
+                            for skipped_file in upgrade_result["skipped_files"]:
+                                st.write(f"- `{skipped_file}`")
+
                     except requests.exceptions.RequestException as e:
+                        upgrade_status.update(label="Upgrade failed", state="error")
                         st.error(f"Error calling upgrade endpoint: {e}")
                     except Exception as e:
+                        upgrade_status.update(label="Upgrade failed", state="error")
                         st.error(f"An unexpected error occurred during upgrade: {e}")
+                    finally:
+                        # Files may have changed, so the detected version is stale; the next upgrade re-detects on the backend
+                        st.session_state['current_java_version'] = None
     else:
         st.info("No upgrade options available for the detected Java version.")
 
@@ -108,7 +145,7 @@ if st.session_state['repo_path'] and st.session_state['current_java_version'] !=
         if st.button("Open Project in VS Code"):
             with st.spinner("Opening VS Code..."):
                 try:
-                    resp = requests.post(f"{BACKEND_URL}/open_vscode", data={"repo_path": st.session_state['repo_path']})
+                    resp = SESSION.post(f"{BACKEND_URL}/open_vscode", data={"repo_path": st.session_state['repo_path']})
                     resp.raise_for_status() # Raise HTTPError for bad responses
                     data = resp.json()
                     if "error" in data:
@@ -1,40 +1,235 @@
 from fastapi import FastAPI, Form, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from typing import Optional
 import os
+import asyncio
+import json
+import hashlib
+import re
 import subprocess
-import requests # Import requests for Ollama API call
-from .utils import clone_repo, detect_java_version, find_java_files # Import find_java_files
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import httpx # Async HTTP client for Ollama API calls
+from .utils import clone_repo, detect_java_version, find_java_files, find_pom_files, GRADLE_BUILD_FILES # Import find_java_files
 import logging
 
 # Configure basic logging (if not already done in utils, good to have here too)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-app = FastAPI()
+# Shared async client so repeated upgrades reuse keep-alive connections to Ollama without tying up a worker thread.
+# The transport retries failed connects; 502/503/504 responses are retried in _open_ollama_stream.
+OLLAMA_CLIENT = httpx.AsyncClient(
+    timeout=600, # Set a generous timeout (10 minutes) for the LLM response
+    transport=httpx.AsyncHTTPTransport(retries=2, limits=httpx.Limits(max_connections=8, max_keepalive_connections=2)),
+    headers={"Connection": "keep-alive"}
+)
+OLLAMA_RETRY_STATUSES = {502, 503, 504}
+OLLAMA_MAX_RETRIES = 2
+# Files are upgraded with one call each; a few run at once and share a cached system-prompt prefix.
+# keep_alive holds the model (and its prompt cache) in memory between calls, and num_ctx must stay
+# fixed across calls since changing it reloads the model.
+OLLAMA_CONCURRENCY = 3
+OLLAMA_KEEP_ALIVE = "30m"
+OLLAMA_NUM_CTX = 16384
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await OLLAMA_CLIENT.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Completed LLM outputs keyed by prompt hash, stored on disk so re-running an unchanged upgrade skips Ollama.
+# Only the most recently used entries are also kept in memory; the rest are re-read from disk on demand.
+PROMPT_CACHE_DIR = os.path.expanduser("~/.java_upgrade_cache")
+PROMPT_CACHE_MAX_IN_MEMORY = 64
+_prompt_cache: OrderedDict[str, str] = OrderedDict()
+_prompt_cache_lock = threading.Lock() # Cache helpers run in worker threads via asyncio.to_thread
+
+# Java sources without any of these are left out of the prompt; they have nothing version-specific to upgrade.
+# Matched against raw bytes so skipped files are never decoded.
+LEGACY_API_RE = re.compile(
+    rb"\b(?:Vector|Enumeration|Hashtable|StringBuffer|finalize|Thread\.stop|SecurityManager|javax\.xml\.bind)\b"
+    rb"|\bsun\.|\bnew (?:Integer|Long|Short|Byte|Double|Float|Boolean|Character)\s*\("
+)
+
+# One "--- File: path ---" header followed by a fenced code block, matched in a single pass over the LLM output
+FILE_BLOCK_RE = re.compile(
+    r"^--- File: (?P<path>[^\n]+?) ---[ \t]*\n[ \t]*```[^\n]*\n(?:(?P<body>.*?)\n)??[ \t]*```[ \t]*(?=\n)",
+    re.MULTILINE | re.DOTALL
+)
+FILE_HEADER_RE = re.compile(r"^--- File: (?P<path>[^\n]+?) ---[ \t]*\n[ \t]*```", re.MULTILINE)
+
+# Files larger than this (bytes) are left out of the upgrade: the file goes into the prompt and is written back
+# in full, so both copies plus the system prompt must fit in OLLAMA_NUM_CTX tokens (~3 bytes per token of code)
+PROMPT_OVERHEAD_TOKENS = 2048
+BYTES_PER_TOKEN = 3
+MAX_FILE_SIZE = (OLLAMA_NUM_CTX - PROMPT_OVERHEAD_TOKENS) // 2 * BYTES_PER_TOKEN
+
+# File I/O is syscall-bound and releases the GIL, so a thread pool overlaps the blocking reads/writes.
+IO_MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+
+def _read_file(file_path):
+    try:
+        with open(file_path, 'rb') as f:
+            return f.read()
+    except Exception as e:
+        logging.error(f"Could not read file {file_path}: {e}")
+        # Skip this file and continue with the others
+        return None
+
+
+def _write_file(abs_file_path, full_content):
+    try:
+        # Ensure parent directory exists
+        os.makedirs(os.path.dirname(abs_file_path), exist_ok=True)
+        with open(abs_file_path, 'w', encoding='utf-8') as f:
+            f.write(full_content)
+        logging.info(f"Successfully wrote changes to {abs_file_path}")
+        return None
+    except Exception as e:
+        logging.error(f"Could not write changes to file {abs_file_path}: {e}")
+        return f"Could not write changes to {os.path.basename(abs_file_path)}: {e}"
+
+def _file_size(file_path):
+    try:
+        return os.path.getsize(file_path)
+    except OSError as e:
+        logging.error(f"Could not read file {file_path}: {e}")
+        return None
+
+
+def _load_file_contents(relevant_files):
+    # Returns (file_contents, unusable_files); file_contents is ordered smallest file first.
+    # unusable_files lists files left out for being too large or not valid UTF-8
+    with ThreadPoolExecutor(max_workers=IO_MAX_WORKERS) as executor:
+        # Stat before reading so huge (typically generated) files are never loaded or sent to the LLM
+        file_sizes = {}
+        unusable_files = []
+        for file_path, size in zip(relevant_files, executor.map(_file_size, relevant_files)):
+            if size is None:
+                continue
+            if size > MAX_FILE_SIZE:
+                logging.warning(f"Skipping {file_path}: {size} bytes exceeds the {MAX_FILE_SIZE} byte limit for a {OLLAMA_NUM_CTX} token context.")
+                unusable_files.append(file_path)
+                continue
+            file_sizes[file_path] = size
+
+        # Small files first, so if the upgrade is cut short as many files as possible have been handled
+        readable_files = sorted(file_sizes, key=lambda file_path: (file_sizes[file_path], file_path))
+        raw_contents = {
+            file_path: content
+            for file_path, content in zip(readable_files, executor.map(_read_file, readable_files))
+            if content is not None
+        }
+
+    # Only send Java sources that use legacy APIs; build files are always kept since they carry the version settings
+    file_contents = {}
+    skipped_files_count = 0
+    for file_path, raw_content in raw_contents.items():
+        if file_path.endswith(".java") and not LEGACY_API_RE.search(raw_content):
+            skipped_files_count += 1
+            continue
+        try:
+            # Strict decode: a lossy one would hand the model (and write back) mangled text
+            file_contents[file_path] = raw_content.decode("utf-8")
+        except UnicodeDecodeError as e:
+            logging.warning(f"Skipping {file_path}: not valid UTF-8 ({e}).")
+            unusable_files.append(file_path)
+    logging.info(f"Skipped {skipped_files_count} Java files with no legacy API usage.")
+    return file_contents, unusable_files
+
+
+def _ollama_payload_base(ollama_model, system_prompt):
+    # Request fields shared by every file in this upgrade; each request adds its own "prompt"
+    return {
+        "model": ollama_model,
+        "system": system_prompt, # Shared prefix, kept warm in Ollama's cache between calls
+        "stream": True, # Ollama sends one JSON object per line as tokens are generated
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "options": {"num_ctx": OLLAMA_NUM_CTX}
+    }
+
+
+def _ollama_payload(payload_base, file_prompt):
+    return json.dumps({**payload_base, "prompt": file_prompt}, ensure_ascii=False).encode('utf-8')
+
+
+def _prompt_cache_key(payload):
+    # The request body covers the model, system prompt (and so both Java versions), generation options and file
+    return hashlib.sha256(payload).hexdigest()
+
+
+def _remember_output(cache_key, llm_output):
+    with _prompt_cache_lock:
+        _prompt_cache[cache_key] = llm_output
+        _prompt_cache.move_to_end(cache_key)
+        while len(_prompt_cache) > PROMPT_CACHE_MAX_IN_MEMORY:
+            _prompt_cache.popitem(last=False)
+
+
+def _load_cached_output(cache_key):
+    with _prompt_cache_lock:
+        if cache_key in _prompt_cache:
+            _prompt_cache.move_to_end(cache_key)
+            return _prompt_cache[cache_key]
+    try:
+        with open(os.path.join(PROMPT_CACHE_DIR, f"{cache_key}.txt"), 'r', encoding='utf-8') as f:
+            llm_output = f.read()
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning(f"Could not read prompt cache entry {cache_key}: {e}")
+        return None
+    _remember_output(cache_key, llm_output)
+    return llm_output
+
+
+def _store_cached_output(cache_key, llm_output):
+    _remember_output(cache_key, llm_output)
+    try:
+        os.makedirs(PROMPT_CACHE_DIR, exist_ok=True)
+        cache_path = os.path.join(PROMPT_CACHE_DIR, f"{cache_key}.txt")
+        # Write to a temp file and rename so a concurrent reader never sees a partial entry
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(llm_output)
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        logging.warning(f"Could not write prompt cache entry {cache_key}: {e}")
 
 # --- NEW BaseModel for Upgrade Request ---
 class UpgradeRequest(BaseModel):
     repo_path: str
     target_version: str
     ollama_model: str = "codeup:latest" # Default Ollama model
+    current_version: Optional[str] = None # As reported by /clone_and_detect; re-detected if missing
 
 # --- Updated Clone Request (if needed, but BaseModel is fine) ---
 class CloneRequest(BaseModel):
     git_url: str
+    sparse_checkout: bool = True # Only check out Java sources and build files; disable for non-Java repos
 
 @app.post("/clone_and_detect")
-def clone_and_detect(req: CloneRequest):
+async def clone_and_detect(req: CloneRequest):
     logging.info(f"Received request to clone and detect: {req.git_url}")
     # Derive a safe directory name from the URL
     # Replace characters that might be invalid in filenames
     repo_name_safe = req.git_url.rstrip('/').split('/')[-1].replace('.git', '').replace('.', '_').replace('-', '_')
     clone_dir = os.path.join("/tmp", repo_name_safe) # Use safe name for directory
 
-    success, msg = clone_repo(req.git_url, clone_dir)
+    success, msg = await clone_repo(req.git_url, clone_dir, sparse=req.sparse_checkout)
     if not success:
         logging.error(f"Clone/update failed: {msg}")
         raise HTTPException(status_code=500, detail=f"Cloning failed: {msg}") # Use HTTPException for FastAPI errors
 
-    version_info = detect_java_version(clone_dir)
+    version_info = await asyncio.to_thread(detect_java_version, clone_dir)
     current_version = version_info["current_version"]
     suggested_versions = version_info["suggested_versions"]
 
@@ -43,7 +238,7 @@ def clone_and_detect(req: CloneRequest):
     return {"repo_path": clone_dir, "current_java_version": current_version, "suggested_java_versions": suggested_versions}
 
 @app.post("/open_vscode")
-def open_vscode(repo_path: str = Form(...)):
+async def open_vscode(repo_path: str = Form(...)):
     logging.info(f"Received request to open VS Code for: {repo_path}")
     try:
         # Ensure the path is valid before attempting to open
@@ -52,9 +247,13 @@ def open_vscode(repo_path: str = Form(...)):
              raise HTTPException(status_code=400, detail=f"Invalid repository path: {repo_path}")
 
         # Check if 'code' command is available in PATH
-        try:
-            subprocess.run(["which", "code"], check=True, capture_output=True)
-        except subprocess.CalledProcessError:
+        which_proc = await asyncio.create_subprocess_exec(
+            "which", "code",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        await which_proc.communicate()
+        if which_proc.returncode != 0:
              logging.error("'code' command not found in PATH.")
              raise HTTPException(status_code=500, detail="'code' command not found. Please install VS Code shell command.")
 
@@ -69,7 +268,7 @@ def open_vscode(repo_path: str = Form(...)):
 
 # --- NEW Endpoint for Java Upgrade ---
 @app.post("/upgrade_java")
-def upgrade_java(req: UpgradeRequest):
+async def upgrade_java(req: UpgradeRequest):
     repo_path = req.repo_path
     target_version = req.target_version
     ollama_model = req.ollama_model
@@ -81,10 +280,8 @@ def upgrade_java(req: UpgradeRequest):
         logging.error(f"Invalid repository path for upgrade: {repo_path}")
         raise HTTPException(status_code=400, detail=f"Invalid repository path: {repo_path}")
 
-    # 1. Detect current Java version (again, or assume it's passed/stored)
-    # For simplicity now, we'll re-detect. In a real app, pass it or store in session.
-    version_info = detect_java_version(repo_path)
-    current_version = version_info["current_version"]
+    # 1. Use the current Java version passed by the frontend, falling back to detection
+    current_version = req.current_version or (await asyncio.to_thread(detect_java_version, repo_path))["current_version"]
 
     if current_version == "Unknown":
         logging.warning(f"Could not detect current Java version in {repo_path}. Cannot proceed with upgrade.")
@@ -96,15 +293,17 @@ def upgrade_java(req: UpgradeRequest):
     logging.info(f"Upgrading from Java {current_version} to {target_version}")
 
     # 2. Find relevant files
-    java_files = find_java_files(repo_path)
-    pom_path = os.path.join(repo_path, "pom.xml")
-    gradle_path = os.path.join(repo_path, "build.gradle")
-
-    relevant_files = java_files
-    if os.path.exists(pom_path):
-        relevant_files.append(pom_path)
-    if os.path.exists(gradle_path):
-        relevant_files.append(gradle_path)
+    # Every module's pom.xml, not just the root one: detection takes the highest version across all of them
+    java_files, pom_files = await asyncio.gather(
+        asyncio.to_thread(find_java_files, repo_path),
+        asyncio.to_thread(find_pom_files, repo_path),
+    )
+
+    relevant_files = java_files + pom_files
+    for gradle_name in GRADLE_BUILD_FILES:
+        gradle_path = os.path.join(repo_path, gradle_name)
+        if os.path.exists(gradle_path):
+            relevant_files.append(gradle_path)
 
     if not relevant_files:
         logging.warning(f"No Java files, pom.xml, or build.gradle found in {repo_path}")
@@ -113,131 +312,254 @@ def upgrade_java(req: UpgradeRequest):
     logging.info(f"Found {len(relevant_files)} relevant files for upgrade.")
 
     # 3. Read file contents and prepare prompt for Ollama
-    file_contents = {}
-    for file_path in relevant_files:
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                file_contents[file_path] = f.read()
-        except Exception as e:
-            logging.error(f"Could not read file {file_path}: {e}")
-            # Decide if you want to skip this file or fail the upgrade
-            # For now, we'll log and continue with other files
-            continue
+    file_contents, unusable_files = await asyncio.to_thread(_load_file_contents, relevant_files)
+    skipped_files = [os.path.relpath(file_path, repo_path) for file_path in unusable_files]
 
-    # Prepare the prompt for the LLM
-    prompt = f"You are a senior Java developer assistant tasked with upgrading a Java project.\n"
-    prompt += f"The project is currently using Java version {current_version} and needs to be upgraded to Java version {target_version}.\n"
-    prompt += f"Carefully review the provided code and configuration files. Make the necessary changes to:\n"
-    prompt += f"- Update dependencies and compiler/runtime versions in pom.xml or build.gradle.\n"
-    prompt += f"- Update Java source code to use features available in Java {target_version} and fix any compatibility issues or deprecations from Java {current_version}.\n"
-    prompt += f"- Modernize usage of legacy Java APIs (e.g., replace Vector/Enumeration with ArrayList/Iterator, update file I/O, networking, etc.) where appropriate.**\n"
-    prompt += f"- Ensure the code follows best practices for Java {target_version}.\n\n"
-    # Clarify the required output format for the LLM, emphasizing the file path after the backticks.
-    # Correcting the f-string syntax.
-    prompt += f'Respond ONLY with the FULL content of the modified files. For each file that requires changes, provide the full content within a markdown code block. It is crucial that you include the file path relative to the repository root immediately after the opening triple backticks, like this:\n\n```path/to/modified/file.java\n// Full upgraded code for this file\n```\n\nIf a file does not need changes, do NOT include it in your response.\n\n'
-
-    prompt += f"Here are the relevant files from the project:\n\n"
+    if not file_contents:
+        logging.warning(f"No files in {repo_path} need upgrading")
+        if skipped_files:
+            return {"status": "No relevant files found for upgrade.", "skipped_files": skipped_files}
+        return {"status": "No relevant files found for upgrade."}
 
+    # Prepare the shared system prompt for the LLM. It is identical for every file in this upgrade,
+    # so Ollama can reuse its KV cache for the instructions and only prefill each file's content.
+    system_prompt = "".join([
+        f"You are a senior Java developer assistant tasked with upgrading a Java project.\n",
+        f"The project is currently using Java version {current_version} and needs to be upgraded to Java version {target_version}.\n",
+        f"Carefully review the provided code or configuration file. Make the necessary changes to:\n",
+        f"- Update dependencies and compiler/runtime versions in pom.xml or build.gradle.\n",
+        f"- Update Java source code to use features available in Java {target_version} and fix any compatibility issues or deprecations from Java {current_version}.\n",
+        f"- Modernize usage of legacy Java APIs (e.g., replace Vector/Enumeration with ArrayList/Iterator, update file I/O, networking, etc.) where appropriate.**\n",
+        f"- Ensure the code follows best practices for Java {target_version}.\n\n",
+        # Clarify the required output format for the LLM; it must match what _parse_file_blocks expects.
+        f'Respond ONLY with the FULL content of the modified file. Start with the same "--- File: <path> ---" line you were given, with the path relative to the repository root, followed by the full content within a markdown code block, like this:\n\n--- File: path/to/modified/file.java ---\n```\n// Full upgraded code for this file\n```\n\nIf the file does not need changes, respond with nothing.\n',
+    ])
+
+    # Paths are relative so prompts (and their cache keys) don't depend on where the repo was cloned;
+    # files stay in smallest-first order. Each prompt is assembled with a single join rather than
+    # repeated += so file contents are copied once.
+    file_prompts = []
     for file_path, content in file_contents.items():
-        prompt += f"--- File: {file_path} ---\n"
-        prompt += f"```\n{content}\n```\n\n"
-
-    logging.info(f"Prepared prompt for Ollama (partial display):\n{prompt[:500]}...") # Log partial prompt
+        file_path_relative = os.path.relpath(file_path, repo_path)
+        file_prompt = "".join((f"--- File: {file_path_relative} ---\n```\n", content, "\n```\n"))
+        file_prompts.append((file_path_relative, file_prompt))
+
+    logging.info(f"Prepared system prompt for Ollama:\n{system_prompt}")
+    logging.info(f"Upgrading {len(file_prompts)} files with up to {OLLAMA_CONCURRENCY} concurrent Ollama calls.")
+
+    # 4. Call Ollama API once per file (streamed, so files can be written while the model is still generating)
+    # 5. Parse LLM responses as they stream and apply changes, reporting progress as NDJSON events
+    return StreamingResponse(
+        _stream_upgrade_events(file_prompts, system_prompt, repo_path, target_version, ollama_api_url, ollama_model, skipped_files),
+        media_type="application/x-ndjson"
+    )
+
+
+async def _open_ollama_stream(ollama_api_url, payload):
+    # payload is the already-encoded JSON body. Returns an open streamed response; the caller is responsible for closing it
+    for attempt in range(OLLAMA_MAX_RETRIES + 1):
+        request = OLLAMA_CLIENT.build_request("POST", ollama_api_url, content=payload, headers={"Content-Type": "application/json"})
+        response = await OLLAMA_CLIENT.send(request, stream=True)
+        if response.status_code in OLLAMA_RETRY_STATUSES and attempt < OLLAMA_MAX_RETRIES:
+            await response.aclose()
+            await asyncio.sleep(0.5 * 2 ** attempt)
+            continue
+        try:
+            response.raise_for_status() # Raise an HTTPStatusError for bad responses (4xx or 5xx)
+        except httpx.HTTPStatusError:
+            await response.aclose()
+            raise
+        return response
 
 
-    # 4. Call Ollama API
+async def _iter_ollama_chunks(response, final_chunk=None):
+    # Each line of the stream is a JSON object carrying the next piece of generated text.
+    # The last object (done=True, with done_reason etc.) is copied into final_chunk if given.
     try:
-        logging.info(f"Calling Ollama API at {ollama_api_url} with model {ollama_model}")
-        response = requests.post(
-            ollama_api_url,
-            json={
-                "model": ollama_model,
-                "prompt": prompt,
-                "stream": False # Set stream to False to get the full response at once
-            },
-            timeout=600 # Set a generous timeout (10 minutes) for the LLM response
-        )
-        response.raise_for_status() # Raise an HTTPError for bad responses (4xx or 5xx)
-        ollama_response_data = response.json()
-        llm_output = ollama_response_data.get("response", "").strip()
-        logging.info(f"Received FULL raw response from Ollama:\n{llm_output}") # Log the full raw response
-
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Error calling Ollama API: {e}")
-        raise HTTPException(status_code=500, detail=f"Error calling Ollama API: {e}. Ensure Ollama is running and accessible at {ollama_api_url} and the model '{ollama_model}' is downloaded.")
-    except Exception as e:
-        logging.error(f"An unexpected error occurred while processing Ollama response: {e}")
-        raise HTTPException(status_code=500, detail=f"An unexpected error occurred with Ollama response: {e}")
-
-
-    # 5. Parse LLM response and apply changes
-    # The LLM is instructed to return markdown code blocks with file paths.
-    # We need to parse this format.
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            data = json.loads(line)
+            if "error" in data:
+                raise ValueError(f"Ollama returned an error: {data['error']}")
+            yield data.get("response", "")
+            if data.get("done"):
+                if final_chunk is not None:
+                    final_chunk.update(data)
+                break
+    finally:
+        await response.aclose()
+
+
+async def _iter_cached_output(cached_output):
+    yield cached_output
+
+
+async def _parse_file_blocks(chunks):
+    # Yields (file_path_relative, full_content) as soon as each block's closing ``` has streamed in.
+    # full_content is None if the response ended before the block was closed.
+    buffer = ""
+    async for chunk in chunks:
+        # Normalise CRLF output to LF, including a "\r" / "\n" pair split across two chunks
+        if buffer.endswith("\r") and chunk.startswith("\n"):
+            buffer = buffer[:-1]
+        buffer += chunk.replace("\r\n", "\n")
+        # A block can only complete once a closing fence arrives, so skip rescanning on fence-free chunks
+        if "`" not in chunk:
+            continue
+        consumed = 0
+        for match in FILE_BLOCK_RE.finditer(buffer):
+            yield match.group("path").strip(), match.group("body") or ""
+            consumed = match.end()
+        buffer = buffer[consumed:]
+
+    # The closing fence must be followed by a newline; at end of stream the last line may not have one
+    buffer = buffer.removesuffix("\r") + "\n"
+    consumed = 0
+    for match in FILE_BLOCK_RE.finditer(buffer):
+        yield match.group("path").strip(), match.group("body") or ""
+        consumed = match.end()
+    unclosed = FILE_HEADER_RE.search(buffer, consumed)
+    if unclosed:
+        yield unclosed.group("path").strip(), None
+
+
+async def _generate_file_blocks(file_prompt, payload_base, ollama_api_url, ollama_model):
+    # Reuse a previous output for an identical request, otherwise stream a fresh one from Ollama
+    payload = _ollama_payload(payload_base, file_prompt)
+    cache_key = _prompt_cache_key(payload)
+    cached_output = await asyncio.to_thread(_load_cached_output, cache_key)
+    if cached_output is not None:
+        logging.info(f"Prompt cache hit ({cache_key}); skipping Ollama call.")
+        async for block in _parse_file_blocks(_iter_cached_output(cached_output)):
+            yield block
+        return
+
+    logging.info(f"Calling Ollama API at {ollama_api_url} with model {ollama_model}")
+    response = await _open_ollama_stream(ollama_api_url, payload)
+
+    llm_output_parts = []
+    final_chunk = {}
+    all_blocks_closed = True
+
+    async def record(chunks):
+        async for chunk in chunks:
+            llm_output_parts.append(chunk)
+            yield chunk
+
+    async for block in _parse_file_blocks(record(_iter_ollama_chunks(response, final_chunk))):
+        if block[1] is None:
+            all_blocks_closed = False
+        yield block
+
+    # Only reached once the whole response has been received
+    llm_output = "".join(llm_output_parts)
+    logging.info(f"Received FULL raw response from Ollama:\n{llm_output}") # Log the full raw response
+
+    # Never cache a truncated answer (e.g. hit the context or length limit); a retry must call Ollama again
+    done_reason = final_chunk.get("done_reason")
+    if all_blocks_closed and done_reason == "stop":
+        await asyncio.to_thread(_store_cached_output, cache_key, llm_output)
+    else:
+        logging.warning(f"Not caching Ollama output ({cache_key}): done_reason={done_reason!r}, all blocks closed={all_blocks_closed}")
+
+
+async def _stream_upgrade_events(file_prompts, system_prompt, repo_path, target_version, ollama_api_url, ollama_model, skipped_files=()):
     updated_files_count = 0
+    failed_ollama_calls = 0
     errors_applying_changes = []
+    pending_writes = {} # abs_file_path -> Future; a repeated path waits for its earlier write so the last block wins
+    results = asyncio.Queue() # ("block", path, content), ("error", message, None) or ("done", None, None) per file
+    semaphore = asyncio.Semaphore(OLLAMA_CONCURRENCY)
+    payload_base = _ollama_payload_base(ollama_model, system_prompt)
+
+    async def upgrade_file(file_path_relative, file_prompt):
+        async with semaphore:
+            try:
+                async for file_path_out, full_content in _generate_file_blocks(file_prompt, payload_base, ollama_api_url, ollama_model):
+                    await results.put(("block", file_path_out, full_content))
+            except httpx.HTTPError as e:
+                logging.error(f"Error calling Ollama API for {file_path_relative}: {e}")
+                await results.put(("error", f"Error calling Ollama API for {file_path_relative}: {e}. Ensure Ollama is running and accessible at {ollama_api_url} and the model '{ollama_model}' is downloaded.", None))
+            except Exception as e:
+                logging.error(f"An unexpected error occurred while processing Ollama response for {file_path_relative}: {e}")
+                await results.put(("error", f"An unexpected error occurred with Ollama response for {file_path_relative}: {e}", None))
+            finally:
+                await results.put(("done", None, None))
+
+    async def collect(write_future):
+        nonlocal updated_files_count
+        write_error = await asyncio.wrap_future(write_future)
+        if write_error:
+            errors_applying_changes.append(write_error)
+        else:
+            updated_files_count += 1
+
+    # Resolved once; each LLM path then costs one realpath and a prefix comparison
+    real_repo = os.path.realpath(repo_path)
 
-    # New parsing logic for the LLM's output format
-    lines = llm_output.splitlines()
-    i = 0
-    while i < len(lines):
-        line = lines[i]
-        if line.startswith("--- File: ") and line.endswith(" ---"):
-            # Found a file path line, extract the path
-            file_path_relative = line[len("--- File: "): -len(" ---")].strip()
-            # Construct the absolute path
-            abs_file_path = os.path.join(repo_path, file_path_relative)
-
-            # Basic path traversal check
-            if os.path.commonpath([os.path.realpath(repo_path), os.path.realpath(abs_file_path)]) != os.path.realpath(repo_path):
-                logging.warning(f"Skipping potentially unsafe path from LLM: {file_path_relative}")
-                i += 1
-                continue # Skip this file
-
-            i += 1 # Move to the next line
-            if i < len(lines) and lines[i].strip() == "```":
-                # Found the start of the code block, collect content until the next ```
-                i += 1 # Move past the opening ```
-                file_content_lines = []
-                while i < len(lines) and lines[i].strip() != "```":
-                    file_content_lines.append(lines[i])
-                    i += 1
-
-                # If we are at the end of lines or found the closing ```
-                if i < len(lines) and lines[i].strip() == "```":
-                    # Found closing ```, save the file
-                    try:
-                        full_content = "\n".join(file_content_lines)
-                        # Ensure parent directory exists
-                        os.makedirs(os.path.dirname(abs_file_path), exist_ok=True)
-                        with open(abs_file_path, 'w', encoding='utf-8') as f:
-                            f.write(full_content)
-                        updated_files_count += 1
-                        logging.info(f"Successfully wrote changes to {abs_file_path}")
-                    except Exception as e:
-                        logging.error(f"Could not write changes to file {abs_file_path}: {e}")
-                        errors_applying_changes.append(f"Could not write changes to {os.path.basename(abs_file_path)}: {e}")
-                    # Move past the closing ```
-                    i += 1
-                else:
+    tasks = [asyncio.create_task(upgrade_file(*file_prompt)) for file_prompt in file_prompts]
+    remaining = len(tasks)
+    try:
+        with ThreadPoolExecutor(max_workers=IO_MAX_WORKERS) as executor:
+            while remaining:
+                kind, file_path_relative, full_content = await results.get()
+                if kind == "done":
+                    remaining -= 1
+                    continue
+                if kind == "error":
+                    failed_ollama_calls += 1
+                    errors_applying_changes.append(file_path_relative)
+                    continue
+
+                if full_content is None:
                     # Code block was not properly closed
                     logging.warning(f"LLM response for file {file_path_relative} ended without a closing ```.")
                     errors_applying_changes.append(f"LLM response for {os.path.basename(file_path_relative)} was incomplete.")
-                    # Continue parsing from the current line, hoping to find another file block
-            else:
-                # Expected a ``` after file path line but didn't find one
-                logging.warning(f"Expected code block after file path {file_path_relative} but didn't find ```.")
-                # Continue parsing from the current line
-        else:
-            # Not a file path line or start of a known block, skip
-            i += 1
+                    continue
+
+                if not full_content.strip():
+                    # An empty block means "nothing to change"; writing it would wipe the file
+                    logging.info(f"LLM returned an empty block for {file_path_relative}; leaving the file unchanged.")
+                    continue
+
+                # Construct the absolute path
+                abs_file_path = os.path.join(repo_path, file_path_relative)
+
+                # Basic path traversal check
+                real_target = os.path.realpath(abs_file_path)
+                if not (real_target == real_repo or real_target.startswith(real_repo + os.sep)):
+                    logging.warning(f"Skipping potentially unsafe path from LLM: {file_path_relative}")
+                    continue # Skip this file
+
+                if abs_file_path in pending_writes:
+                    await collect(pending_writes.pop(abs_file_path))
+                pending_writes[abs_file_path] = executor.submit(_write_file, abs_file_path, full_content)
+                yield json.dumps({"event": "file", "path": file_path_relative}) + "\n"
+
+            for write_future in pending_writes.values():
+                await collect(write_future)
+    finally:
+        # Stop outstanding Ollama calls if the client disconnects mid-stream
+        for task in tasks:
+            task.cancel()
 
     logging.info(f"Upgrade process finished. Updated {updated_files_count} files.")
 
-    if errors_applying_changes:
+    if file_prompts and failed_ollama_calls == len(file_prompts):
+         # Not a single file got a response, e.g. Ollama is down or the model is missing
+         logging.error("Upgrade failed: every Ollama call failed.")
+         done_event = {"event": "done", "status": "Upgrade failed", "details": errors_applying_changes}
+    elif errors_applying_changes:
          error_message = "Upgrade completed with errors:\n" + "\n".join(errors_applying_changes)
          logging.error(error_message)
          # You might want to return a 500 status code or a detailed error message
          # depending on how critical these errors are.
-         return {"status": "Upgrade finished with errors", "details": errors_applying_changes}
-
-    return {"status": f"Successfully upgraded {updated_files_count} files to Java {target_version}"}
+         done_event = {"event": "done", "status": "Upgrade finished with errors", "details": errors_applying_changes}
+    else:
+         done_event = {"event": "done", "status": f"Successfully upgraded {updated_files_count} files to Java {target_version}"}
+
+    if skipped_files:
+        # Files left out for being too large or not valid UTF-8, so the user can upgrade them by hand
+        done_event["skipped_files"] = list(skipped_files)
+    yield json.dumps(done_event) + "\n"